@@ -1,59 +1,201 @@
 import streamlit as st
-import json
+import orjson
 import os
-from sklearn.feature_extraction.text import TfidfVectorizer
-from sklearn.metrics.pairwise import cosine_similarity
+import glob
+import hashlib
+import tempfile
+import joblib
+from sklearn.feature_extraction.text import HashingVectorizer, TfidfTransformer
+from sklearn.pipeline import Pipeline
+from sklearn.preprocessing import normalize
 import numpy as np
 from typing import List, Dict, Any
 import re
 from collections import defaultdict
 
+PLATFORMS = ['segment', 'mparticle', 'lytics', 'zeotap']
+# Cap on the content vectorized per doc, so a runaway page can't blow up the fit.
+# Set above nearly every bundled page: relevant text isn't confined to the start.
+MAX_VECTORIZED_CHARS = 32000
+
 class CDPChatbot:
+    # Query patterns, compiled once and shared by every chat turn
+    _comparison_re = re.compile(
+        r'compare|difference|versus|vs|different|better'
+        r'|how does (\w+) compare to (\w+)'
+        r'|which platform (is|has) better'
+    )
+    _feature_re = re.compile(r'compare.+?(?:for|in|with)\s+([^?]+)')
+    _numbered_step_re = re.compile(r'\d+\.\s+')
+    _bullet_step_re = re.compile(r'[•\-\*]\s+')
+    _word_re = re.compile(r'\w+')
+
     def __init__(self, docs_directory: str = "cdp_docs"):
         self.docs_directory = docs_directory
         self.docs_data = self.load_all_docs()
-        self.vectorizer = TfidfVectorizer(
-            stop_words='english',
-            ngram_range=(1, 2),
-            max_features=10000
-        )
+        # Hash terms into fixed buckets so only the IDF weights need fitting
+        self.vectorizer = Pipeline([
+            ('hv', HashingVectorizer(
+                stop_words='english',
+                ngram_range=(1, 2),
+                n_features=2**18,
+                alternate_sign=False,
+                norm=None
+            )),
+            ('tfidf', TfidfTransformer(norm='l2'))
+        ])
         self.doc_vectors = None
         self.process_documents()
+        # idf_ is recomputed from the IDF diagonal on every access, so read it once
+        self._idf = self.vectorizer.named_steps['tfidf'].idf_
+        self.build_keyword_index()
         
     def load_all_docs(self) -> List[Dict[str, Any]]:
         """Load documentation from all CDP platforms"""
         all_docs = []
-        for platform in ['segment', 'mparticle', 'lytics', 'zeotap']:
+        for platform in PLATFORMS:
             file_path = os.path.join(self.docs_directory, f"{platform}_docs.json")
             try:
-                with open(file_path, 'r', encoding='utf-8') as f:
-                    platform_docs = json.load(f)
+                with open(file_path, 'rb') as f:
+                    platform_docs = orjson.loads(f.read())
                     all_docs.extend(platform_docs)
             except FileNotFoundError:
                 st.warning(f"Documentation for {platform} not found.")
+
+        # Lowercase searchable fields once instead of on every comparison query
+        for doc in all_docs:
+            doc['_content_lower'] = doc['content'].lower()
+            doc['_keywords_joined_lower'] = ' '.join(doc['keywords']).lower()
+            # Token sets are only present in docs scraped after they were added; they
+            # save re-tokenizing the content when building the keyword index
+            if '_tokens' in doc:
+                doc['_tokens'] = set(doc['_tokens'].split())
         return all_docs
 
+    def docs_hash(self) -> str:
+        """Hash the docs files and vectorizer settings to key the vector cache"""
+        digest = hashlib.blake2b(digest_size=16)
+        digest.update(repr(sorted(self.vectorizer.get_params().items())).encode('utf-8'))
+        digest.update(str(MAX_VECTORIZED_CHARS).encode('utf-8'))
+        for platform in PLATFORMS:
+            file_path = os.path.join(self.docs_directory, f"{platform}_docs.json")
+            digest.update(platform.encode('utf-8'))
+            if os.path.exists(file_path):
+                with open(file_path, 'rb') as f:
+                    digest.update(f.read())
+        return digest.hexdigest()
+
+    def iter_doc_texts(self):
+        """Yield the text to vectorize for each document, truncating long content"""
+        for doc in self.docs_data:
+            yield f"{doc['title']} {doc['content'][:MAX_VECTORIZED_CHARS]} {' '.join(doc['keywords'])}"
+
     def process_documents(self):
-        """Process and vectorize all documents"""
-        # Prepare document texts with metadata
-        self.doc_texts = [
-            f"{doc['title']} {doc['content']} {' '.join(doc['keywords'])}"
-            for doc in self.docs_data
-        ]
-        
-        # Create document vectors
-        self.doc_vectors = self.vectorizer.fit_transform(self.doc_texts)
+        """Process and vectorize all documents, reusing cached vectors when available"""
+        cache_file = os.path.join(self.docs_directory, f"cdp_cache_{self.docs_hash()}.joblib")
+        try:
+            self.vectorizer, doc_vectors = joblib.load(cache_file, mmap_mode='r')
+            # Caches written before doc vectors were stored column-major hold CSR
+            self.doc_vectors = doc_vectors.tocsc(copy=False)
+            return
+        except FileNotFoundError:
+            pass
+        except Exception:
+            # A truncated or corrupt cache would fail every startup, so drop it and refit
+            self.remove_cache_file(cache_file)
+
+        # Create document vectors, streaming the texts instead of holding them in a list.
+        # They are kept column-major so a query only reads the columns of its own terms.
+        self.doc_vectors = self.vectorizer.fit_transform(self.iter_doc_texts()).tocsc()
+
+        # Cache the fitted vectorizer and vectors. Writing to a temp file and renaming it
+        # means concurrent sessions never load a partially written cache.
+        try:
+            fd, tmp_file = tempfile.mkstemp(prefix='cdp_cache_', suffix='.tmp', dir=self.docs_directory)
+            os.close(fd)
+            os.chmod(tmp_file, 0o644)  # mkstemp creates owner-only files
+            try:
+                joblib.dump((self.vectorizer, self.doc_vectors), tmp_file)
+                os.replace(tmp_file, cache_file)
+            finally:
+                self.remove_cache_file(tmp_file)
+        except OSError:
+            return  # Caching is best effort; a read-only docs directory just refits
+
+        # Only drop caches of older docs once the new one is in place
+        for stale_file in glob.glob(os.path.join(self.docs_directory, "cdp_cache_*.joblib")):
+            if stale_file != cache_file:
+                self.remove_cache_file(stale_file)
+
+    @staticmethod
+    def remove_cache_file(file_path: str):
+        """Remove a cache file, ignoring files that are already gone or not removable"""
+        try:
+            os.remove(file_path)
+        except OSError:
+            pass
         
+    def build_keyword_index(self):
+        """Map every word of each doc's title, content and keywords to the docs containing it"""
+        self._keyword_index = defaultdict(set)
+        for i, doc in enumerate(self.docs_data):
+            words = set(self._word_re.findall(doc['title'].lower()))
+            words.update(self._word_re.findall(doc['_keywords_joined_lower']))
+            if '_tokens' in doc:
+                words.update(doc['_tokens'])
+            else:
+                words.update(self._word_re.findall(doc['_content_lower']))
+            for word in words:
+                self._keyword_index[word].add(i)
+        # One indexed word per line, so a regex can find every word extending a feature word
+        self._indexed_words = '\n'.join(self._keyword_index)
+
+    def find_candidate_docs(self, feature_lower: str) -> List[int]:
+        """Return the indices of docs that may contain feature_lower, in corpus order"""
+        matches = list(self._word_re.finditer(feature_lower))
+        if not matches:
+            return list(range(len(self.docs_data)))
+
+        candidate_idxs = None
+        for match in matches:
+            # A word with non-word characters on both sides in the feature must be a whole
+            # word of the doc; at the feature's start or end it may be part of a longer one
+            open_start = match.start() == 0
+            open_end = match.end() == len(feature_lower)
+            if open_start or open_end:
+                pattern = (r'\w*' if open_start else '') + re.escape(match.group()) + (r'\w*' if open_end else '')
+                words = re.findall(f'^{pattern}$', self._indexed_words, re.MULTILINE)
+                postings = set().union(*(self._keyword_index[word] for word in words))
+            else:
+                postings = self._keyword_index.get(match.group(), set())
+            candidate_idxs = postings if candidate_idxs is None else candidate_idxs & postings
+            if not candidate_idxs:
+                break
+        return sorted(candidate_idxs)
+
+    def vectorize_query(self, query: str):
+        """Vectorize a query like the fitted pipeline, weighting only its nonzero terms"""
+        # TfidfTransformer.transform multiplies by a full n_features x n_features IDF
+        # diagonal; with 2**18 hashed features that dominated per-query cost
+        query_vector = self.vectorizer.named_steps['hv'].transform([query])
+        query_vector.data *= self._idf[query_vector.indices]
+        return normalize(query_vector, norm='l2', copy=False)
+
     def search_docs(self, query: str, top_k: int = 3) -> List[Dict[str, Any]]:
         """Search for relevant documents based on the query"""
         # Vectorize the query
-        query_vector = self.vectorizer.transform([query])
+        query_vector = self.vectorize_query(query)
         
-        # Calculate similarities
-        similarities = cosine_similarity(query_vector, self.doc_vectors)[0]
+        # Calculate similarities; the TF-IDF step L2-normalizes query and doc vectors,
+        # so cosine similarity is a dot product over the query's nonzero terms only
+        similarities = self.doc_vectors[:, query_vector.indices] @ query_vector.data
         
-        # Get top-k documents
-        top_indices = np.argsort(similarities)[-top_k:][::-1]
+        # Get top-k documents, partitioning first so only k entries get sorted
+        top_k = min(top_k, len(similarities))
+        if top_k <= 0:
+            return []
+        top_indices = np.argpartition(similarities, -top_k)[-top_k:]
+        top_indices = top_indices[np.argsort(-similarities[top_indices])]
         
         return [
             {
@@ -63,24 +205,32 @@ class CDPChatbot:
             for idx in top_indices
         ]
 
+    @staticmethod
+    def split_at_markers(marker_re: re.Pattern, content: str) -> List[str]:
+        """Split content into the text following each marker, in one forward scan"""
+        markers = list(marker_re.finditer(content))
+        ends = [marker.start() for marker in markers[1:]] + [len(content)]
+        return [content[marker.end():end].strip() for marker, end in zip(markers, ends)]
+
     def extract_steps(self, content: str) -> List[str]:
         """Extract steps from content"""
         # Look for numbered steps
-        numbered_steps = re.findall(r'\d+\.\s+(.*?)(?=\d+\.|$)', content, re.DOTALL)
+        numbered_steps = self.split_at_markers(self._numbered_step_re, content)
         if numbered_steps:
-            return [step.strip() for step in numbered_steps]
+            return numbered_steps
         
         # Look for bullet points if no numbered steps
-        bullet_steps = re.findall(r'[•\-\*]\s+(.*?)(?=[•\-\*]|$)', content, re.DOTALL)
-        return [step.strip() for step in bullet_steps]
+        return self.split_at_markers(self._bullet_step_re, content)
 
     def compare_platforms(self, feature: str) -> str:
         """Compare how different platforms handle a specific feature"""
         feature_docs = defaultdict(list)
         
-        # Search for relevant docs across platforms
-        for doc in self.docs_data:
-            if feature.lower() in doc['content'].lower() or feature.lower() in ' '.join(doc['keywords']).lower():
+        # Only visit docs indexed under every word of the feature
+        feature_lower = feature.lower()
+        for idx in self.find_candidate_docs(feature_lower):
+            doc = self.docs_data[idx]
+            if feature_lower in doc['_content_lower'] or feature_lower in doc['_keywords_joined_lower']:
                 feature_docs[doc['platform']].append(doc)
         
         if not feature_docs:
@@ -102,18 +252,13 @@ class CDPChatbot:
     def generate_response(self, query: str) -> str:
         """Generate a response based on the query"""
         # Check if it's a comparison question
-        comparison_patterns = [
-            r'compare|difference|versus|vs|different|better',
-            r'how does (\w+) compare to (\w+)',
-            r'which platform (is|has) better'
-        ]
-        
-        is_comparison = any(re.search(pattern, query.lower()) for pattern in comparison_patterns)
+        query_lower = query.lower()
+        is_comparison = bool(self._comparison_re.search(query_lower))
         
         if is_comparison:
             # Extract the feature to compare
-            feature_match = re.search(r'compare.+?(for|in|with)\s+([^?]+)', query.lower())
-            feature = feature_match.group(2) if feature_match else query.split()[-1]
+            feature_match = self._feature_re.search(query_lower)
+            feature = feature_match.group(1) if feature_match else query.split()[-1]
             return self.compare_platforms(feature)
         
         # Regular search
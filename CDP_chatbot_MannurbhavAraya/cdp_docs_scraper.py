@@ -1,19 +1,103 @@
-import requests
-from bs4 import BeautifulSoup
-import json
+import httpx
+import lxml.html
+from lxml.html.clean import Cleaner
+import orjson
 import os
-from urllib.parse import urljoin, urlparse
+from urllib.parse import urljoin, urlparse, urldefrag, urlsplit, urlunsplit, parse_qsl, urlencode
 import time
 import logging
-from concurrent.futures import ThreadPoolExecutor
+import threading
+from queue import Queue
 import re
 
+def canonicalize_url(url):
+    """Normalize a URL so variants of the same page share one visited key"""
+    parts = urlsplit(urldefrag(url)[0])
+    query = urlencode(sorted(parse_qsl(parts.query)))
+    return urlunsplit((parts.scheme, parts.netloc.lower(), parts.path.rstrip('/') or '/', query, ''))
+
+class TokenBucket:
+    """Thread-safe token bucket limiting how often requests are sent"""
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.last_refill = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        """Block until a token is available, then consume it"""
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.last_refill) * self.rate)
+            self.last_refill = now
+            if self.tokens < 1:
+                time.sleep((1 - self.tokens) / self.rate)
+                self.tokens = 1
+                self.last_refill = time.monotonic()
+            self.tokens -= 1
+
 class CDPDocScraper:
+    _numbered_step_re = re.compile(r'\d+\.\s+')
+    _bullet_step_re = re.compile(r'[•\-\*]\s+')
+
+    MAX_WORKERS = 5
+    REQUESTS_PER_SECOND = 5
+
+    # Candidate main content containers, in order of preference
+    MAIN_CONTENT_XPATHS = [
+        './/main',
+        './/article',
+        ".//div[contains(concat(' ', normalize-space(@class), ' '), ' content ')]"
+    ]
+
+    # Page type keywords, checked against the title in priority order
+    CONTENT_TYPES = {
+        'how-to': ['how to', 'guide', 'tutorial'],
+        'technical-reference': ['api', 'reference', 'sdk'],
+        'conceptual': ['concept', 'overview', 'introduction']
+    }
+    CATEGORIES = {
+        'setup': ['setup', 'installation', 'getting started'],
+        'integration': ['integrate', 'connection', 'connector'],
+        'user_management': ['user', 'profile', 'identity'],
+        'data_management': ['data', 'schema', 'model'],
+        'analytics': ['analytics', 'reporting', 'dashboard'],
+        'security': ['security', 'privacy', 'authentication']
+    }
+    TECHNICAL_TERMS = ['api', 'sdk', 'code', 'implementation', 'configuration']
+    # Common CDP-related terms
+    CDP_TERMS = frozenset(['segment', 'audience', 'profile', 'integration', 'source', 'destination',
+                           'tracking', 'identity', 'data', 'analytics', 'api'])
+
     def __init__(self):
-        self.session = requests.Session()
-        self.session.headers.update({
-            'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
-        })
+        # One thread-safe HTTP/2 client shared by all workers, multiplexing requests per host
+        self.session = httpx.Client(
+            http2=True,
+            headers={
+                'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36'
+            },
+            timeout=10.0,
+            follow_redirects=True,
+            limits=httpx.Limits(max_connections=20, max_keepalive_connections=20)
+        )
+        # Drop scripts, styles and page chrome in one pass, leaving everything else intact
+        self._cleaner = Cleaner(
+            scripts=True,
+            javascript=False,
+            comments=True,
+            style=True,
+            links=False,
+            meta=False,
+            page_structure=False,
+            embedded=False,
+            frames=False,
+            forms=False,
+            annoying_tags=False,
+            remove_unknown_tags=False,
+            safe_attrs_only=False,
+            kill_tags=['nav', 'header', 'footer']
+        )
         self.setup_logging()
         
     def setup_logging(self):
@@ -29,13 +113,17 @@ class CDPDocScraper:
 
     def create_doc_structure(self, url, content, title, platform):
         """Create a structured document with metadata"""
+        # Tokenize once; keywords are filtered from the tokens, and the tokens are
+        # persisted space-joined since indented JSON puts each list item on its own line
+        tokens = set(re.findall(r'\b\w+\b', f"{title} {content}".lower()))
         return {
             'url': url,
             'title': title,
             'platform': platform,
             'content': content,
             'type': self.classify_content(title, content),
-            'keywords': self.extract_keywords(title, content),
+            'keywords': self.extract_keywords(tokens),
+            '_tokens': ' '.join(sorted(tokens)),
             'howto_steps': self.extract_steps(content),
             'metadata': {
                 'last_updated': None,  # To be filled if available
@@ -47,64 +135,49 @@ class CDPDocScraper:
     def classify_content(self, title, content):
         """Classify the type of documentation page"""
         title_lower = title.lower()
-        content_lower = content.lower()
         
-        if any(word in title_lower for word in ['how to', 'guide', 'tutorial']):
-            return 'how-to'
-        elif any(word in title_lower for word in ['api', 'reference', 'sdk']):
-            return 'technical-reference'
-        elif any(word in title_lower for word in ['concept', 'overview', 'introduction']):
-            return 'conceptual'
+        for content_type, words in self.CONTENT_TYPES.items():
+            if any(word in title_lower for word in words):
+                return content_type
         return 'general'
 
-    def extract_keywords(self, title, content):
-        """Extract relevant keywords from the content"""
-        # Common CDP-related terms
-        cdp_terms = ['segment', 'audience', 'profile', 'integration', 'source', 'destination',
-                    'tracking', 'identity', 'data', 'analytics', 'api']
-        
-        # Extract words that might be important
-        words = re.findall(r'\b\w+\b', f"{title} {content}".lower())
-        return list(set([word for word in words if word in cdp_terms or len(word) > 4]))
+    def extract_keywords(self, tokens):
+        """Extract relevant keywords from the page's lowercased tokens"""
+        # Keep words that might be important
+        return [word for word in tokens if word in self.CDP_TERMS or len(word) > 4]
+
+    @staticmethod
+    def split_at_markers(marker_re, content):
+        """Split content into the text following each marker, in one forward scan"""
+        markers = list(marker_re.finditer(content))
+        ends = [marker.start() for marker in markers[1:]] + [len(content)]
+        return [content[marker.end():end].strip() for marker, end in zip(markers, ends)]
 
     def extract_steps(self, content):
         """Extract numbered steps or bullet points from content"""
         steps = []
         # Look for numbered steps
-        numbered_steps = re.findall(r'\d+\.\s+(.*?)(?=\d+\.|$)', content, re.DOTALL)
-        if numbered_steps:
-            steps.extend(numbered_steps)
+        steps.extend(self.split_at_markers(self._numbered_step_re, content))
         
         # Look for bullet points
-        bullet_points = re.findall(r'[•\-\*]\s+(.*?)(?=[•\-\*]|$)', content, re.DOTALL)
-        if bullet_points:
-            steps.extend(bullet_points)
+        steps.extend(self.split_at_markers(self._bullet_step_re, content))
             
-        return [step.strip() for step in steps if step.strip()]
+        return [step for step in steps if step]
 
     def determine_category(self, title, content):
         """Determine the category of the documentation"""
         title_lower = title.lower()
         content_lower = content.lower()
         
-        categories = {
-            'setup': ['setup', 'installation', 'getting started'],
-            'integration': ['integrate', 'connection', 'connector'],
-            'user_management': ['user', 'profile', 'identity'],
-            'data_management': ['data', 'schema', 'model'],
-            'analytics': ['analytics', 'reporting', 'dashboard'],
-            'security': ['security', 'privacy', 'authentication']
-        }
-        
-        for category, keywords in categories.items():
+        for category, keywords in self.CATEGORIES.items():
             if any(keyword in title_lower or keyword in content_lower for keyword in keywords):
                 return category
         return 'general'
 
     def estimate_difficulty(self, content):
         """Estimate the difficulty level of the content"""
-        technical_terms = ['api', 'sdk', 'code', 'implementation', 'configuration']
-        technical_count = sum(term in content.lower() for term in technical_terms)
+        content_lower = content.lower()
+        technical_count = sum(term in content_lower for term in self.TECHNICAL_TERMS)
         
         if technical_count > 5:
             return 'advanced'
@@ -128,7 +201,16 @@ class CDPDocScraper:
         """Generic platform scraping method"""
         self.logger.info(f"Starting to scrape {platform_name} documentation...")
         docs = []
+        # Canonical URLs claimed by a fetch in flight or done, and those fetched successfully
         visited = set()
+        fetched = set()
+        # Raw URL variants already queued, and variants held back per canonical URL in case
+        # the variant being fetched fails
+        tried_urls = set()
+        pending_variants = {}
+        visited_lock = threading.Lock()
+        frontier = Queue()
+        rate_limiter = TokenBucket(self.REQUESTS_PER_SECOND, self.REQUESTS_PER_SECOND)
         
         def is_valid_url(url):
             parsed = urlparse(url)
@@ -138,65 +220,107 @@ class CDPDocScraper:
                 not any(pattern in url for pattern in ['login', 'sign-in', 'search'])
             )
 
+        def enqueue(url):
+            url = urldefrag(url)[0]
+            if not is_valid_url(url):
+                return
+            canonical_url = canonicalize_url(url)
+            with visited_lock:
+                if canonical_url in fetched or url in tried_urls:
+                    return
+                tried_urls.add(url)
+                if canonical_url in visited:
+                    pending_variants.setdefault(canonical_url, []).append(url)
+                    return
+                visited.add(canonical_url)
+            frontier.put(url)
+
+        def settle(url, succeeded):
+            # Record a fetch result; on failure fall back to the page's next variant
+            canonical_url = canonicalize_url(url)
+            with visited_lock:
+                variants = pending_variants.pop(canonical_url, [])
+                if succeeded:
+                    fetched.add(canonical_url)
+                    return
+                if not variants:
+                    # Release the page so a variant discovered later can still be tried
+                    visited.discard(canonical_url)
+                    return
+                next_url = variants.pop(0)
+                if variants:
+                    pending_variants[canonical_url] = variants
+            frontier.put(next_url)
+
         def process_page(url):
-            if url in visited or not is_valid_url(url):
-                return []
-            
-            visited.add(url)
+            # Returns the page's links, or None if the page couldn't be fetched
+            response = None
             try:
-                response = self.session.get(url, timeout=10)
+                # Be respectful to the servers
+                rate_limiter.acquire()
+                response = self.session.get(url)
                 if response.status_code != 200:
                     self.logger.warning(f"Failed to fetch {url}: {response.status_code}")
-                    return []
+                    return None
                 
-                soup = BeautifulSoup(response.text, 'html.parser')
+                tree = lxml.html.fromstring(response.content)
                 
                 # Extract main content (adjust selectors based on the platform's HTML structure)
-                main_content = soup.find('main') or soup.find('article') or soup.find('div', class_='content')
-                if not main_content:
+                main_content = next(
+                    (matches[0] for matches in map(tree.xpath, self.MAIN_CONTENT_XPATHS) if matches),
+                    None
+                )
+                if main_content is None:
                     return []
                 
-                # Clean the content
-                for tag in main_content(['script', 'style', 'nav', 'header', 'footer']):
-                    tag.decompose()
+                # Clean the content in place
+                self._cleaner(main_content)
                 
-                content = main_content.get_text(strip=True, separator=' ')
-                title = soup.title.string if soup.title else url.split('/')[-1]
+                # Join stripped text nodes with a space so adjacent elements don't run together
+                content = ' '.join(text.strip() for text in main_content.itertext() if text.strip())
+                title = tree.findtext('.//title') or url.split('/')[-1]
                 
                 # Create structured document
                 doc = self.create_doc_structure(url, content, title, platform_name)
                 docs.append(doc)
                 
                 # Find more links to scrape
-                links = main_content.find_all('a', href=True)
-                return [urljoin(base_url, link['href']) for link in links]
+                links = main_content.xpath('.//a/@href')
+                return [urljoin(base_url, href) for href in links]
             
             except Exception as e:
                 self.logger.error(f"Error processing {url}: {str(e)}")
-                return []
+                return None if response is None else []
 
-        # Start with the base URL
-        urls_to_process = [base_url]
-        
-        # Process URLs in parallel
-        with ThreadPoolExecutor(max_workers=5) as executor:
-            while urls_to_process:
-                new_urls = []
-                future_to_url = {executor.submit(process_page, url): url 
-                               for url in urls_to_process[:5]}  # Process 5 at a time
-                
-                for future in future_to_url:
-                    new_urls.extend(future.result())
-                
-                urls_to_process = list(set(new_urls) - visited)
-                
-                # Add delay to be respectful to the servers
-                time.sleep(1)
+        def worker():
+            # Pull URLs until a None sentinel arrives, queueing newly found links
+            while True:
+                url = frontier.get()
+                try:
+                    if url is None:
+                        return
+                    links = process_page(url)
+                    settle(url, links is not None)
+                    for new_url in links or []:
+                        enqueue(new_url)
+                finally:
+                    frontier.task_done()
+
+        # Start with the base URL and keep every worker busy until the frontier drains
+        enqueue(base_url)
+        workers = [threading.Thread(target=worker, daemon=True) for _ in range(self.MAX_WORKERS)]
+        for thread in workers:
+            thread.start()
+        frontier.join()
+        for _ in workers:
+            frontier.put(None)
+        for thread in workers:
+            thread.join()
         
         # Save the results
         output_file = f"{platform_name}_docs.json"
-        with open(output_file, 'w', encoding='utf-8') as f:
-            json.dump(docs, f, indent=2, ensure_ascii=False)
+        with open(output_file, 'wb') as f:
+            f.write(orjson.dumps(docs, option=orjson.OPT_INDENT_2))
         
         self.logger.info(f"Completed scraping {platform_name}. Found {len(docs)} documents.")
         return docs
@@ -221,11 +345,13 @@ def main():
             
             # Save platform-specific data
             output_file = os.path.join('cdp_docs', f"{platform}_docs.json")
-            with open(output_file, 'w', encoding='utf-8') as f:
-                json.dump(docs, f, indent=2, ensure_ascii=False)
+            with open(output_file, 'wb') as f:
+                f.write(orjson.dumps(docs, option=orjson.OPT_INDENT_2))
                 
         except Exception as e:
             scraper.logger.error(f"Failed to scrape {platform}: {str(e)}")
 
+    scraper.session.close()
+
 if __name__ == "__main__":
     main()